@@ -1,5 +1,16 @@
+import zipfile
+
 import streamlit as st
 
+# zipfile liczy CRC-32 każdego wpisu przez zlib.crc32. zlib-ng robi to instrukcjami
+# PCLMULQDQ/VPCLMULQDQ, wielokrotnie szybciej — przy wpisach ZIP_STORED to jedyna
+# praca na bajtach. Wynik identyczny; bez pakietu zostaje zwykły zlib.
+try:
+    from zlib_ng import zlib_ng
+    zipfile.crc32 = zlib_ng.crc32
+except ImportError:
+    pass
+
 if st.query_params.get("health") == "check":
     st.write("OK")
     st.stop()
@@ -1,17 +1,23 @@
 import streamlit as st
 import streamlit.components.v1 as components
 import pandas as pd
-import requests
+import aiohttp
+import asyncio
 import os
 import base64
+import hashlib
 import json
+import time
 from pathlib import Path
 from urllib.parse import urlparse
-import time
 from PIL import Image
 import io
+import tempfile
 import zipfile
-from datetime import datetime
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
 
 st.markdown("""
 <style>
@@ -22,46 +28,88 @@ st.markdown("""
 """, unsafe_allow_html=True)
 
 TIMEOUT = 30
-ALLOWED_FORMATS = {'.jpg', '.jpeg', '.png', '.gif', '.webp', '.bmp'}
-SKIP_FORMATS    = {'.pdf', '.html', '.htm', '.svg', '.tiff', '.tif', '.eps', '.ai', '.psd'}
+LIMIT_NA_SERWER = 4
+POOL_MAXSIZE    = 64
+DNS_CACHE_TTL   = 300
+RETRY_TOTAL     = 3
+RETRY_BACKOFF   = 0.5
+RETRY_STATUSES  = frozenset({429, 500, 502, 503, 504})
+CHUNK_SIZE      = 64 << 10
+MAX_IMAGE_BYTES = 50 << 20
+CACHE_DIR       = Path.home() / '.cache' / 'okladki'
+CACHE_MAX_AGE   = 7 * 24 * 3600  # s — po tygodniu okładka pobierana jest ponownie
+CACHE_MAX_BYTES = 1 << 30
+UI_INTERVAL     = 0.1  # s — każda aktualizacja widżetu to komunikat websocket do przeglądarki
+SKIP_FORMATS    = frozenset({'.pdf', '.html', '.htm', '.svg', '.tiff', '.tif', '.eps', '.ai', '.psd'})
 DEFAULT_FORMAT  = '.jpg'
-
-ALLOWED_CONTENT_TYPES = {
+URL_PATH_RE     = r'^(?:[A-Za-z][A-Za-z0-9+.\-]*:)?(?://[^/?#]*)?([^?#]*)'  # ścieżka jak urlparse(...).path
+URL_EXT_RE      = r'[^/.][^/]*?(\.[^./]*)$'                                 # rozszerzenie jak os.path.splitext
+COMPRESSED_FORMATS = frozenset({'.jpg', '.jpeg', '.png', '.gif', '.webp'})
+ZIP_DEFLATE_LEVEL = 1  # ~3× szybciej niż domyślne 6, rozmiar prawie ten sam
+JPEG_SIGNATURE  = b'\xff\xd8\xff'
+MAGIC_BYTES     = (
+    (JPEG_SIGNATURE, '.jpg'),
+    (b'\x89PNG\r\n\x1a\n', '.png'),
+    (b'GIF8', '.gif'),
+    (b'BM', '.bmp'),
+)
+PNG_COMPRESS_LEVEL = 6  # optimize=True to zlib 9 + przeszukiwanie filtrów: wielokrotnie wolniej, zysk ~0–3%
+
+ALLOWED_CONTENT_TYPES = frozenset({
     'image/jpeg', 'image/png', 'image/gif',
     'image/webp', 'image/bmp', 'image/x-bmp'
-}
-SKIP_CONTENT_TYPES = {
+})
+SKIP_CONTENT_TYPES = frozenset({
     'application/pdf',
     'text/html', 'text/plain', 'application/xhtml+xml',
     'image/svg+xml', 'image/tiff'
+})
+
+HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
+    'Accept': 'image/avif,image/webp,image/apng,image/svg+xml,image/*,*/*;q=0.8',
+    'Accept-Language': 'pl-PL,pl;q=0.9,en-US;q=0.8,en;q=0.7',
+    'Referer': 'https://www.google.com/',
+    'Cache-Control': 'no-cache',
+    'Connection': 'keep-alive'
 }
 
 
 # ── Pomocnicze funkcje obrazu ────────────────────────────────────────────────
 
 def has_transparency(image):
+    """Tryby bez kanału alfa odrzuca bez czytania pikseli; dla RGBA/LA skanuje tylko kanał A."""
     if image.mode in ('RGBA', 'LA'):
-        alpha = image.split()[-1]
-        return alpha.getextrema() != (255, 255)
+        return image.getchannel('A').getextrema()[0] < 255
     elif image.mode == 'P':
         return 'transparency' in image.info
     return False
 
 
+def flatten_on_white(image):
+    """
+    Spłaszcza przezroczystość na białe tło (wynik w trybie RGB).
+    Jedno wklejenie RGBA/LA → RGB z alfą jako maską, bez split() i pośrednich kopii RGBA.
+    """
+    if image.mode not in ('RGBA', 'LA'):
+        image = image.convert('RGBA')
+    background = Image.new('RGB', image.size, (255, 255, 255))
+    background.paste(image, mask=image)
+    return background
+
+
 def add_white_background(image_bytes):
     """Dodaje białe tło do obrazu z przezroczystością."""
+    # JPEG nie ma kanału alfa — bez otwierania przez PIL (parsowanie znaczników, EXIF/ICC)
+    if image_bytes[:3] == JPEG_SIGNATURE:
+        return image_bytes
     try:
         image = Image.open(io.BytesIO(image_bytes))
         if not has_transparency(image):
             return image_bytes
-        if image.mode != 'RGBA':
-            image = image.convert('RGBA')
-        background = Image.new('RGBA', image.size, (255, 255, 255, 255))
-        background.paste(image, mask=image.split()[-1])
-        final_image = background.convert('RGB')
+        final_image = flatten_on_white(image)
         output = io.BytesIO()
-        fmt = 'JPEG' if getattr(image, 'format', '') in ['JPEG', 'JPG'] else 'PNG'
-        final_image.save(output, format=fmt, quality=95, optimize=True)
+        final_image.save(output, format='PNG', compress_level=PNG_COMPRESS_LEVEL)
         return output.getvalue()
     except Exception:
         return image_bytes
@@ -79,13 +127,9 @@ def convert_to_jpg(image_bytes, source_format: str) -> bytes:
         if source_format == '.gif' and hasattr(image, 'n_frames') and image.n_frames > 1:
             image.seek(0)
 
-        # Spłaszcz przezroczystość na białe tło
-        if has_transparency(image) or image.mode in ('RGBA', 'LA', 'P'):
-            if image.mode != 'RGBA':
-                image = image.convert('RGBA')
-            background = Image.new('RGB', image.size, (255, 255, 255))
-            background.paste(image, mask=image.split()[-1])
-            image = background
+        # Spłaszcz przezroczystość na białe tło (has_transparency zbędne — tryb wystarcza)
+        if image.mode in ('RGBA', 'LA', 'P'):
+            image = flatten_on_white(image)
         elif image.mode != 'RGB':
             image = image.convert('RGB')
 
@@ -101,15 +145,11 @@ def convert_webp_to_png(image_bytes, remove_transparency=False) -> bytes:
     try:
         image = Image.open(io.BytesIO(image_bytes))
         if remove_transparency and has_transparency(image):
-            if image.mode != 'RGBA':
-                image = image.convert('RGBA')
-            background = Image.new('RGB', image.size, (255, 255, 255))
-            background.paste(image, mask=image.split()[-1])
-            image = background
+            image = flatten_on_white(image)
         elif image.mode not in ('RGBA', 'LA') and image.mode != 'RGB':
             image = image.convert('RGB')
         output = io.BytesIO()
-        image.save(output, format='PNG', optimize=True)
+        image.save(output, format='PNG', compress_level=PNG_COMPRESS_LEVEL)
         return output.getvalue()
     except Exception as e:
         raise Exception(f"Błąd konwersji WebP → PNG: {e}")
@@ -117,47 +157,167 @@ def convert_webp_to_png(image_bytes, remove_transparency=False) -> bytes:
 
 # ── Sieć i walidacja ─────────────────────────────────────────────────────────
 
-def pobierz_obraz(url, timeout=TIMEOUT):
-    """Pobiera obraz; zwraca cały obiekt Response (potrzebny do nagłówków)."""
-    headers = {
-        'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
-        'Accept': 'image/avif,image/webp,image/apng,image/svg+xml,image/*,*/*;q=0.8',
-        'Accept-Language': 'pl-PL,pl;q=0.9,en-US;q=0.8,en;q=0.7',
-        'Referer': 'https://www.google.com/',
-        'Cache-Control': 'no-cache',
-        'Connection': 'keep-alive'
-    }
-    for attempt in range(3):
+def czas_retry_after(naglowek, domyslny):
+    """Odstęp z nagłówka Retry-After (sekundy lub data HTTP), ograniczony do TIMEOUT."""
+    if not naglowek:
+        return domyslny
+    try:
+        sekundy = float(naglowek)
+    except ValueError:
         try:
-            response = requests.get(url, headers=headers, timeout=timeout, stream=True)
-            response.raise_for_status()
-            return response
-        except requests.exceptions.RequestException as e:
-            if attempt < 2:
-                time.sleep(2)
-                continue
-            raise e
+            sekundy = (parsedate_to_datetime(naglowek) - datetime.now(timezone.utc)).total_seconds()
+        except (TypeError, ValueError):
+            return domyslny
+    return min(max(sekundy, 0.0), TIMEOUT)
+
 
+async def czytaj_tresc(response):
+    """Czyta treść odpowiedzi porcjami CHUNK_SIZE; przerywa, gdy plik przekracza MAX_IMAGE_BYTES."""
+    if (response.content_length or 0) > MAX_IMAGE_BYTES:
+        raise ValueError(f"Plik większy niż {MAX_IMAGE_BYTES >> 20} MB")
+    bufor = bytearray()
+    async for chunk in response.content.iter_chunked(CHUNK_SIZE):
+        bufor += chunk
+        if len(bufor) > MAX_IMAGE_BYTES:
+            raise ValueError(f"Plik większy niż {MAX_IMAGE_BYTES >> 20} MB")
+    return bytes(bufor)
 
-def sprawdz_format_z_url(link_str):
-    """Sprawdza rozszerzenie w URL. Zwraca (ext, powod_pominiecia | None)."""
-    parsed = urlparse(link_str)
-    path = parsed.path.lower()
-    ext = os.path.splitext(path)[1]
 
-    for skip_ext in SKIP_FORMATS:
-        if path.endswith(skip_ext):
-            return ext, f"Nieobsługiwany format: {skip_ext.upper()} (z URL)"
+async def pobierz_obraz(session, url, sem, timeout=TIMEOUT):
+    """
+    Pobiera obraz; zwraca (Content-Type, bajty). `sem` ogranicza równoległość per serwer.
+    Ponawia tylko błędy połączenia i statusy z RETRY_STATUSES (odstęp wykładniczy albo
+    wg Retry-After); pozostałe błędy HTTP, np. 404, i nieprawidłowe URL zgłaszane są od razu.
+    """
+    async with sem:
+        for attempt in range(RETRY_TOTAL + 1):
+            delay = RETRY_BACKOFF * 2 ** attempt
+            try:
+                async with session.get(url, timeout=aiohttp.ClientTimeout(total=timeout)) as response:
+                    if response.status in RETRY_STATUSES and attempt < RETRY_TOTAL:
+                        delay = czas_retry_after(response.headers.get('Retry-After'), delay)
+                    else:
+                        response.raise_for_status()
+                        content_type = response.headers.get('Content-Type', '')
+                        if not sprawdz_content_type(content_type)[0]:
+                            return content_type, b''  # zadanie i tak zostanie pominięte — treść zbędna
+                        return content_type, await czytaj_tresc(response)
+            except (aiohttp.ClientResponseError, aiohttp.InvalidURL):
+                raise
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                if attempt == RETRY_TOTAL:
+                    raise
+            await asyncio.sleep(delay)
+
+
+def sciezka_cache(url):
+    key = hashlib.sha256(url.encode()).hexdigest()
+    return CACHE_DIR / key[:2] / key
+
+
+def odczytaj_z_cache(url):
+    """Zwraca (Content-Type, bajty) zapisane wcześniej dla URL albo None (brak lub wpis przeterminowany)."""
+    cache_path = sciezka_cache(url)
+    try:
+        if time.time() - cache_path.stat().st_mtime > CACHE_MAX_AGE:
+            return None
+        raw = cache_path.read_bytes()
+    except OSError:
+        return None
+    content_type, _, data = raw.partition(b'\n')
+    return content_type.decode('utf-8', 'replace'), data
+
+
+def zapisz_do_cache(url, content_type, data):
+    """Zapis atomowy (plik tymczasowy + replace); błędy zapisu nie przerywają pobierania."""
+    cache_path = sciezka_cache(url)
+    tmp = None
+    try:
+        cache_path.parent.mkdir(parents=True, exist_ok=True)
+        with tempfile.NamedTemporaryFile(dir=cache_path.parent, delete=False) as tmp:
+            tmp.write(content_type.encode('utf-8', 'replace') + b'\n')
+            tmp.write(data)
+        os.replace(tmp.name, cache_path)
+    except OSError:
+        if tmp is not None:
+            try:
+                os.unlink(tmp.name)
+            except OSError:
+                pass
 
-    if ext in ALLOWED_FORMATS:
-        return ext, None
 
-    return ext or DEFAULT_FORMAT, None
+def przytnij_cache():
+    """
+    Usuwa wpisy starsze niż CACHE_MAX_AGE, a gdy reszta przekracza CACHE_MAX_BYTES —
+    najstarsze, aż cache zmieści się w limicie. Wywoływane na początku każdej paczki.
+    """
+    teraz = time.time()
+    wpisy = []
+    for plik in CACHE_DIR.glob('*/*'):
+        try:
+            info = plik.stat()
+            if teraz - info.st_mtime > CACHE_MAX_AGE:
+                plik.unlink()
+            else:
+                wpisy.append((info.st_mtime, info.st_size, plik))
+        except OSError:
+            continue
+
+    rozmiar = sum(size for _, size, _ in wpisy)
+    for _, size, plik in sorted(wpisy):
+        if rozmiar <= CACHE_MAX_BYTES:
+            break
+        try:
+            plik.unlink()
+            rozmiar -= size
+        except OSError:
+            continue
 
 
-def sprawdz_content_type(response):
+async def pobierz_obraz_z_cache(session, url, sem, use_cache=True):
+    """
+    pobierz_obraz z pamięcią podręczną na dysku (klucz: SHA-256 URL), współdzieloną
+    między uruchomieniami. Zwraca (Content-Type, bajty, z_cache). Zapis do cache
+    robi obsluz_zadanie — dopiero gdy obraz przejdzie walidację PIL.
+    """
+    if use_cache:
+        cached = await asyncio.to_thread(odczytaj_z_cache, url)
+        if cached is not None:
+            return *cached, True
+
+    content_type, data = await pobierz_obraz(session, url, sem)
+    return content_type, data, False
+
+
+def sprawdz_formaty_z_url(links):
+    """
+    Sprawdza rozszerzenia w całej kolumnie linków jednym przebiegiem regex (pandas).
+    URL służy tylko do odrzucenia formatów nieobsługiwanych (PDF, HTML…) bez pobierania;
+    rozszerzenie zapisywanego pliku ustala rozpoznaj_format() z treści.
+    Zwraca Series z powodem pominięcia; brak powodu → None.
+    """
+    path = links.str.extract(URL_PATH_RE, expand=False).str.lower()
+    ext  = path.str.extract(URL_EXT_RE, expand=False).fillna('')
+    skip = ext.isin(SKIP_FORMATS)
+
+    powod = pd.Series(None, index=links.index, dtype=object)
+    powod[skip] = "Nieobsługiwany format: " + ext[skip].str.upper() + " (z URL)"
+    return powod
+
+
+def rozpoznaj_format(data):
+    """Rozszerzenie na podstawie sygnatury pliku (pierwsze 12 bajtów), nie URL ani Content-Type."""
+    if data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+        return '.webp'
+    for signature, ext in MAGIC_BYTES:
+        if data.startswith(signature):
+            return ext
+    return DEFAULT_FORMAT
+
+
+def sprawdz_content_type(content_type):
     """Sprawdza Content-Type. Zwraca (ok, powod | None)."""
-    ct = response.headers.get('Content-Type', '').split(';')[0].strip().lower()
+    ct = content_type.partition(';')[0].strip().lower()
 
     if ct in ALLOWED_CONTENT_TYPES:
         return True, None
@@ -179,15 +339,218 @@ def waliduj_pil(image_bytes):
         return False, f"Plik nie jest prawidłowym obrazem: {e}"
 
 
-# ── ZIP ──────────────────────────────────────────────────────────────────────
+# ── Pobieranie równoległe ────────────────────────────────────────────────────
+
+def przetworz_obraz(image_data, extension, ean_label, opcje):
+    """
+    Walidacja PIL i konwersje formatów (kroki CPU, uruchamiane w puli wątków
+    równolegle z trwającymi pobraniami). Każdy obraz jest niezależny.
+    """
+    # ── 4. Walidacja PIL ──────────────────────────────────────────────────
+    pil_ok, pil_reason = waliduj_pil(image_data)
+    if not pil_ok:
+        return {'status': 'pominiete', 'msg': f"EAN: {ean_label} | Pominięto — {pil_reason}"}
+
+    original_ext = extension
+    konwersja    = None
+
+    # ── 6. Konwersje formatów ─────────────────────────────────────────────
+    try:
+        # WebP → JPG (przezroczystość zawsze na białe tło)
+        if opcje['convert_webp'] and original_ext == '.webp' and opcje['webp_target'] == '.jpg':
+            opis = 'WebP→JPG'
+            image_data = convert_to_jpg(image_data, source_format='.webp')
+            extension, konwersja = '.jpg', 'webp'
+
+        # WebP → PNG
+        elif opcje['convert_webp'] and original_ext == '.webp':
+            opis = 'WebP→PNG'
+            image_data = convert_webp_to_png(image_data, remove_transparency=opcje['handle_transparency'])
+            extension, konwersja = '.png', 'webp'
+
+        # GIF → JPG
+        elif opcje['convert_gif'] and original_ext == '.gif':
+            opis = 'GIF→JPG'
+            image_data = convert_to_jpg(image_data, source_format='.gif')
+            extension, konwersja = '.jpg', 'gif_jpg'
+
+        # BMP → JPG
+        elif opcje['convert_bmp'] and original_ext == '.bmp':
+            opis = 'BMP→JPG'
+            image_data = convert_to_jpg(image_data, source_format='.bmp')
+            extension, konwersja = '.jpg', 'bmp_jpg'
+
+        # Białe tło dla pozostałych formatów (JPG/PNG) z przezroczystością
+        elif opcje['handle_transparency']:
+            processed = add_white_background(image_data)
+            if processed != image_data:
+                image_data, konwersja = processed, 'transparency_fixed'
+    except Exception as e:
+        return {'status': 'blad', 'msg': f"EAN: {ean_label} | Błąd konwersji {opis}: {e}"}
+
+    return {'status': 'sukces', 'data': image_data, 'extension': extension, 'konwersja': konwersja}
+
+
+async def obsluz_zadanie(pobierz, executor, zadanie, opcje):
+    """Pobiera jeden link i przetwarza obraz. Zwraca słownik wyniku (status, msg / dane)."""
+    ean_label = zadanie['ean_label']
+
+    # ── 2. Pobieranie ─────────────────────────────────────────────────────
+    try:
+        content_type, image_data, z_cache = await pobierz(zadanie['link'])
+    except aiohttp.InvalidURL:
+        return {'status': 'blad', 'msg': f"EAN: {ean_label} | Nieprawidłowy URL: {zadanie['link']}"}
+    except Exception as e:
+        return {'status': 'blad', 'msg': f"EAN: {ean_label} | Błąd pobierania: {str(e) or type(e).__name__}"}
+
+    # ── 3. Weryfikacja Content-Type ───────────────────────────────────────
+    ct_ok, ct_reason = sprawdz_content_type(content_type)
+    if not ct_ok:
+        return {'status': 'pominiete', 'msg': f"EAN: {ean_label} | Pominięto — {ct_reason}"}
+
+    # ── 5. Ustal rozszerzenie z treści ────────────────────────────────────
+    extension = rozpoznaj_format(image_data)
+
+    loop = asyncio.get_running_loop()
+    try:
+        wynik = await loop.run_in_executor(executor, przetworz_obraz, image_data, extension, ean_label, opcje)
+    except Exception as e:
+        return {'status': 'blad', 'msg': f"EAN: {ean_label} | Błąd przetwarzania: {e}"}
+
+    # Do cache trafiają tylko oryginalne bajty, które przeszły walidację PIL
+    # (strona błędu HTML podana jako image/jpeg nie zostanie zapamiętana)
+    if wynik['status'] == 'sukces' and not z_cache:
+        await asyncio.to_thread(zapisz_do_cache, zadanie['link'], content_type, image_data)
+    return wynik
+
+
+async def pobierz_wszystkie(zadania, opcje, postep, limit_na_serwer=LIMIT_NA_SERWER):
+    """
+    Pobiera wszystkie zadania równolegle (osobny semafor na każdy serwer).
+    Link powtórzony w arkuszu pobierany jest raz, a wynik trafia do każdego zadania.
+    `postep(n, zadanie)` wywoływane jest po zakończonych zadaniach, najwyżej
+    co UI_INTERVAL sekund oraz zawsze po ostatnim.
+    Zwraca wyniki w kolejności zadań.
+    """
+    wyniki       = [None] * len(zadania)
+    per_host_sem = {}
+    kolejka      = asyncio.Queue()
+    powtorzone   = {url for url, n in Counter(z['link'] for z in zadania).items() if n > 1}
+    wspolne      = {}
+
+    await asyncio.to_thread(przytnij_cache)
+
+    def pobierz(url):
+        sem = per_host_sem.setdefault(urlparse(url).netloc, asyncio.Semaphore(limit_na_serwer))
+        if url not in powtorzone:
+            return pobierz_obraz_z_cache(session, url, sem, opcje['use_cache'])
+        if url not in wspolne:
+            wspolne[url] = asyncio.ensure_future(pobierz_obraz_z_cache(session, url, sem, opcje['use_cache']))
+        return wspolne[url]
+
+    async def wykonaj(i, zadanie):
+        wyniki[i] = await obsluz_zadanie(pobierz, executor, zadanie, opcje)
+        kolejka.put_nowait(i)
+
+    # Pillow zwalnia GIL przy dekodowaniu, wklejaniu i kodowaniu (zlib), więc wątki
+    # wykorzystują wszystkie rdzenie; procesy odpadają, bo funkcji ze skryptu strony
+    # Streamlit nie da się zaimportować w procesie potomnym (spawn na Windows).
+    with ThreadPoolExecutor(max_workers=os.cpu_count(), thread_name_prefix='okladki') as executor:
+        # Jedna sesja na całą paczkę: połączenia TCP/TLS są utrzymywane (keep-alive)
+        # i ponownie używane, więc handshake wykonywany jest raz na serwer, nie raz na obraz.
+        connector = aiohttp.TCPConnector(
+            limit=POOL_MAXSIZE, limit_per_host=limit_na_serwer, ttl_dns_cache=DNS_CACHE_TTL
+        )
+        async with aiohttp.ClientSession(connector=connector, headers=HEADERS) as session:
+
+            async def pobieraj():
+                async with asyncio.TaskGroup() as tg:
+                    for i, zadanie in enumerate(zadania):
+                        tg.create_task(wykonaj(i, zadanie))
+
+            # Postęp raportowany z głównej korutyny, żeby wyjątki sterujące Streamlit
+            # (zatrzymanie / ponowne uruchomienie skryptu) nie trafiały do ExceptionGroup.
+            pobieranie = asyncio.create_task(pobieraj())
+            try:
+                last_update = 0.0
+                for n in range(1, len(zadania) + 1):
+                    z_kolejki = asyncio.ensure_future(kolejka.get())
+                    await asyncio.wait((z_kolejki, pobieranie), return_when=asyncio.FIRST_COMPLETED)
+                    if z_kolejki.done():
+                        i = z_kolejki.result()
+                    else:
+                        z_kolejki.cancel()
+                        await pobieranie          # błąd w TaskGroup — zgłoś go zamiast czekać w nieskończoność
+                        i = kolejka.get_nowait()  # zakończone poprawnie — reszta wyników już w kolejce
+                    if time.monotonic() - last_update > UI_INTERVAL or n == len(zadania):
+                        postep(n, zadania[i])
+                        last_update = time.monotonic()
+                await pobieranie
+            finally:
+                pobieranie.cancel()
+
+    return wyniki
+
+
+# ── ZIP i podgląd ────────────────────────────────────────────────────────────
 
 def create_zip_from_memory(files_dict):
+    """
+    Buduje ZIP z plików w pamięci. Formaty już skompresowane zapisywane są bez
+    ponownej kompresji (ZIP_STORED).
+    """
     zip_buffer = io.BytesIO()
-    with zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_DEFLATED) as zip_file:
+    with zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_DEFLATED, compresslevel=ZIP_DEFLATE_LEVEL) as zip_file:
         for filename, file_data in files_dict.items():
-            zip_file.writestr(filename, file_data)
-    zip_buffer.seek(0)
-    return zip_buffer
+            ext = os.path.splitext(filename)[1].lower()
+            compress_type = zipfile.ZIP_STORED if ext in COMPRESSED_FORMATS else zipfile.ZIP_DEFLATED
+            zip_file.writestr(filename, file_data, compress_type=compress_type)
+    return zip_buffer.getvalue()
+
+
+def miniatura_b64(image_bytes, size):
+    """Miniatura PNG (base64) do podglądu."""
+    img = Image.open(io.BytesIO(image_bytes))
+    img.thumbnail((size, size))
+    buf = io.BytesIO()
+    img.save(buf, format='PNG')
+    return base64.b64encode(buf.getvalue()).decode()
+
+
+@st.cache_data(show_spinner=False, max_entries=4)
+def wczytaj_arkusz(file_bytes, file_name):
+    """
+    Wczytuje arkusz parserem calamine (Rust) zamiast openpyxl; CSV parserem pyarrow.
+    Excel zostaje przy typach numpy — kolumna mieszająca liczby z tekstem (np. 5 i "brak")
+    nie da się zamienić na typ Arrow; wybrane kolumny linków konwertowane są później.
+    Wynik jest cache'owany, więc przeładowania strony nie parsują pliku ponownie.
+    """
+    if file_name.lower().endswith('.csv'):
+        # Polski Excel zapisuje CSV w cp1250 — parser oczekuje UTF-8, więc przekoduj
+        try:
+            file_bytes.decode('utf-8-sig')
+        except UnicodeDecodeError:
+            file_bytes = file_bytes.decode('cp1250', 'replace').encode('utf-8')
+        naglowek = file_bytes.split(b'\n', 1)[0]
+        sep = ';' if naglowek.count(b';') > naglowek.count(b',') else ','
+        return pd.read_csv(io.BytesIO(file_bytes), sep=sep, engine='pyarrow', dtype_backend='pyarrow')
+    return pd.read_excel(io.BytesIO(file_bytes), engine='calamine')
+
+
+def normalizuj_ean(kolumna):
+    """
+    Wektorowa normalizacja kolumny EAN (odpowiednik str(int(float(ean))) dla każdego wiersza).
+    Liczby → tekst bez części ułamkowej, pozostałe wartości → tekst bez spacji, puste → None.
+    """
+    puste  = kolumna.isna().to_numpy(dtype=bool)
+    liczby = pd.to_numeric(kolumna, errors='coerce').astype('float64')  # jak float(ean); Arrow null → NaN
+    is_int = (liczby.abs() < 2 ** 63).to_numpy(dtype=bool)            # NaN / inf / poza zakresem int64 → ścieżka tekstowa
+    reszta = ~puste & ~is_int
+
+    ean_norm = pd.Series(None, index=kolumna.index, dtype=object)
+    ean_norm[is_int] = liczby[is_int].astype('int64').astype(str)
+    ean_norm[reszta] = kolumna[reszta].astype(str).str.strip().str.replace(' ', '', regex=False)
+    return ean_norm
 
 
 def parse_ean_list(ean_text):
@@ -240,6 +603,11 @@ if swap_param and st.session_state.download_results:
             data_b = files.pop(key_b)
             files[f"{ean}{suf_a}{ext_b}"] = data_b
 
+        # Nazwy plików się zmieniły — archiwum i miniatury tego EAN zostaną zbudowane od nowa
+        st.session_state.download_results['zip_data'] = None
+        miniatury = st.session_state.download_results.get('miniatury', {})
+        for fname in [k for k in miniatury if k.rsplit('.', 1)[0].split('_')[0] == ean]:
+            del miniatury[fname]
         st.query_params.clear()
     except Exception as e:
         st.query_params.clear()
@@ -252,20 +620,29 @@ st.markdown("---")
 with st.sidebar:
     st.header("⚙️ Ustawienia")
 
-    delay_between = st.slider(
-        "Opóźnienie między pobraniami (s)",
-        min_value=0.2, max_value=5.0, value=1.5,
-        help="Im większe opóźnienie, tym mniejsza szansa na blokadę (zalecane: 1.5s)"
+    limit_na_serwer = st.slider(
+        "Równoległe pobrania na serwer",
+        min_value=1, max_value=8, value=LIMIT_NA_SERWER,
+        help="Im mniej równoległych pobrań, tym mniejsza szansa na blokadę (zalecane: 4)"
     )
 
     st.markdown("#### 🖼️ Konwersje formatów")
     handle_transparency = st.checkbox("Dodaj białe tło do przezroczystości", value=True)
-    convert_webp = st.checkbox("Konwertuj .webp → .png", value=True)
+    convert_webp = st.checkbox("Konwertuj .webp", value=True)
+    webp_target  = st.radio(
+        "Format docelowy dla .webp", ['.png', '.jpg'], horizontal=True, disabled=not convert_webp,
+        help="JPG jest zwykle kilkukrotnie mniejszy i szybciej zapisywany niż PNG; przezroczystość zastępowana jest białym tłem"
+    )
     convert_gif  = st.checkbox("Konwertuj .gif → .jpg (1. klatka)", value=True)
     convert_bmp  = st.checkbox("Konwertuj .bmp → .jpg", value=True)
 
     st.markdown("---")
     overwrite = st.checkbox("Nadpisuj istniejące pliki", value=False)
+    use_cache = st.checkbox(
+        "Używaj pamięci podręcznej pobrań", value=True,
+        help=f"Pobrane obrazy zapisywane są w {CACHE_DIR} i nie są pobierane ponownie przy kolejnych "
+             f"uruchomieniach (przez {CACHE_MAX_AGE // 86400} dni, łącznie do {CACHE_MAX_BYTES >> 30} GB)"
+    )
 
     if st.session_state.download_results:
         st.markdown("---")
@@ -275,12 +652,12 @@ with st.sidebar:
 
 # ── Główna część ─────────────────────────────────────────────────────────────
 
-uploaded_file = st.file_uploader("Wybierz plik Excel", type=['xlsx', 'xls'])
+uploaded_file = st.file_uploader("Wybierz plik Excel lub CSV", type=['xlsx', 'xls', 'csv'])
 
 if uploaded_file is not None:
     try:
         with st.spinner("Wczytywanie pliku..."):
-            df = pd.read_excel(uploaded_file)
+            df = wczytaj_arkusz(uploaded_file.getvalue(), uploaded_file.name)
 
         st.success(f"✅ Wczytano: **{uploaded_file.name}** | Wierszy: **{len(df)}**")
 
@@ -332,183 +709,104 @@ if uploaded_file is not None:
 
             downloaded_files = {}
             ean_filter_set   = parse_ean_list(ean_filter_text) if ean_filter_text else None
-            found_eans       = set()
 
             stats = {
                 'sukces': 0, 'blad': 0, 'istnieje': 0,
                 'pominiete': 0, 'puste_wiersze': 0, 'nieznalezione_ean': 0,
-                'webp_png': 0, 'gif_jpg': 0, 'bmp_jpg': 0, 'transparency_fixed': 0,
+                'webp': 0, 'gif_jpg': 0, 'bmp_jpg': 0, 'transparency_fixed': 0,
             }
             errors_log  = []
             skipped_log = []
 
             progress_bar = st.progress(0)
             status_text  = st.empty()
-            log_expander = st.expander("⚠️ Dziennik zdarzeń", expanded=True)
 
-            total_rows = len(df)
-            total_tasks = total_rows * len(link_columns)
-            task_counter = 0
+            # ── 1. Normalizacja EAN, filtr i weryfikacja URL (wektorowo) ──────
+            df['_ean_norm'] = normalizuj_ean(df[ean_column])
+            brak_ean = df['_ean_norm'].isna().to_numpy(dtype=bool)
+            stats['puste_wiersze'] += int(brak_ean.sum())
+            df = df[~brak_ean]
+
+            # Filtr przed czymkolwiek innym — przy 50 EAN-ach na 50 000 wierszy
+            # dalsza praca dotyczy tylko pasujących wierszy
+            if ean_filter_set:
+                w_filtrze = df['_ean_norm'].isin(ean_filter_set).to_numpy(dtype=bool)
+                stats['nieznalezione_ean'] = int((~w_filtrze).sum())
+                df = df[w_filtrze]
+            found_eans = set(df['_ean_norm'])
+
+            # Jeden wiersz na link: (EAN, kolumna, link, powód pominięcia)
+            czesci = []
+            for col_num, col_name in link_columns:
+                links = df[col_name].astype('string[pyarrow]').str.strip()
+                pusty = links.fillna('').eq('').to_numpy(dtype=bool)
+                stats['puste_wiersze'] += int(pusty.sum())
+                links = links[~pusty]
+                ean   = df['_ean_norm'][~pusty]
+                czesci.append(pd.DataFrame({
+                    'ean': ean,
+                    'col_num': col_num,
+                    'ean_label': ean if col_num == 0 else ean + f"_{col_num}",
+                    'link': links.astype(object),
+                    'powod': sprawdz_formaty_z_url(links),
+                }))
+            # Stabilne sortowanie po indeksie przywraca kolejność: wiersz, potem kolumna
+            linki = pd.concat(czesci).sort_index(kind='stable')
+
+            pominiete = linki['powod'].notna().to_numpy(dtype=bool)
+            skipped_log += ("EAN: " + linki['ean_label'][pominiete]
+                            + " | Pominięto — " + linki['powod'][pominiete]).tolist()
+            stats['pominiete'] += int(pominiete.sum())
+            linki = linki[~pominiete]
+
+            # Odrzucane są tylko identyczne trójki (EAN, kolumna, link) — dałyby ten sam plik.
+            # Różne linki dla tego samego EAN zostają: pierwszy może się nie pobrać albo
+            # dać inne rozszerzenie; o zapisie decyduje krok 7.
+            duplikat = linki.duplicated(subset=['ean', 'col_num', 'link'])
+            stats['istnieje'] += int(duplikat.sum())
+            zadania = linki.loc[~duplikat.to_numpy(dtype=bool),
+                                ['ean', 'col_num', 'ean_label', 'link']].to_dict('records')
+
+            # ── 2–6. Pobieranie i konwersje (równolegle) ──────────────────────
+            opcje = {
+                'handle_transparency': handle_transparency,
+                'convert_webp': convert_webp,
+                'webp_target': webp_target,
+                'use_cache': use_cache,
+                'convert_gif': convert_gif,
+                'convert_bmp': convert_bmp,
+            }
+            total_tasks = len(zadania)
 
-            for idx, row in df.iterrows():
+            def postep(n, zadanie):
+                progress_bar.progress(min(n / total_tasks, 1.0))
+                status_text.text(f"Pobrano: {zadanie['ean_label']} ({n}/{total_tasks})")
 
-                ean = row[ean_column]
+            wyniki = asyncio.run(pobierz_wszystkie(zadania, opcje, postep, limit_na_serwer)) if zadania else []
+            progress_bar.progress(1.0)
 
-                if pd.isna(ean):
-                    stats['puste_wiersze'] += 1
-                    task_counter += len(link_columns)
-                    progress_bar.progress(min(task_counter / total_tasks, 1.0))
+            # ── 7. Zapis (w kolejności wierszy) ───────────────────────────────
+            for zadanie, wynik in zip(zadania, wyniki):
+                if wynik['status'] == 'pominiete':
+                    skipped_log.append(wynik['msg'])
+                    stats['pominiete'] += 1
+                    continue
+                if wynik['status'] == 'blad':
+                    errors_log.append(wynik['msg'])
+                    stats['blad'] += 1
                     continue
 
-                try:
-                    ean = str(int(float(ean))).strip().replace(' ', '')
-                except Exception:
-                    ean = str(ean).strip().replace(' ', '')
+                if wynik['konwersja']:
+                    stats[wynik['konwersja']] += 1
 
-                if ean_filter_set and ean not in ean_filter_set:
-                    stats['nieznalezione_ean'] += 1
-                    task_counter += len(link_columns)
-                    progress_bar.progress(min(task_counter / total_tasks, 1.0))
+                extension = wynik['extension']
+                filename  = f"{zadanie['ean']}{extension}" if zadanie['col_num'] == 0 else f"{zadanie['ean_label']}{extension}"
+                if filename in downloaded_files and not overwrite:
+                    stats['istnieje'] += 1
                     continue
 
-                found_eans.add(ean)
-
-                for col_num, col_name in link_columns:
-                    task_counter += 1
-                    progress_bar.progress(min(task_counter / total_tasks, 1.0))
-
-                    link = row[col_name]
-
-                    if pd.isna(link) or str(link).strip() == '':
-                        stats['puste_wiersze'] += 1
-                        continue
-
-                    link_str = str(link).strip()
-                    ean_label = ean if col_num == 0 else f"{ean}_{col_num}"
-                    status_text.text(f"Pobieranie: {ean_label} ({task_counter}/{total_tasks})")
-
-                    # ── 1. Weryfikacja URL ────────────────────────────────────────
-                    ext_from_url, skip_reason = sprawdz_format_z_url(link_str)
-                    if skip_reason:
-                        msg = f"EAN: {ean_label} | Pominięto — {skip_reason}"
-                        skipped_log.append(msg)
-                        log_expander.warning(msg)
-                        stats['pominiete'] += 1
-                        continue
-
-                    # ── 2. Pobieranie ─────────────────────────────────────────────
-                    try:
-                        response = pobierz_obraz(link_str)
-                    except Exception as e:
-                        msg = f"EAN: {ean_label} | Błąd pobierania: {e}"
-                        errors_log.append(msg)
-                        log_expander.error(msg)
-                        stats['blad'] += 1
-                        time.sleep(delay_between)
-                        continue
-
-                    # ── 3. Weryfikacja Content-Type ───────────────────────────────
-                    ct_ok, ct_reason = sprawdz_content_type(response)
-                    if not ct_ok:
-                        msg = f"EAN: {ean_label} | Pominięto — {ct_reason}"
-                        skipped_log.append(msg)
-                        log_expander.warning(msg)
-                        stats['pominiete'] += 1
-                        time.sleep(delay_between)
-                        continue
-
-                    image_data = response.content
-
-                    # ── 4. Walidacja PIL ──────────────────────────────────────────
-                    pil_ok, pil_reason = waliduj_pil(image_data)
-                    if not pil_ok:
-                        msg = f"EAN: {ean_label} | Pominięto — {pil_reason}"
-                        skipped_log.append(msg)
-                        log_expander.warning(msg)
-                        stats['pominiete'] += 1
-                        time.sleep(delay_between)
-                        continue
-
-                    # ── 5. Ustal rozszerzenie z Content-Type ─────────────────────
-                    ct_header = response.headers.get('Content-Type', '').split(';')[0].strip().lower()
-                    ct_ext_map = {
-                        'image/jpeg': '.jpg', 'image/png': '.png', 'image/gif': '.gif',
-                        'image/webp': '.webp', 'image/bmp': '.bmp'
-                    }
-                    extension    = ct_ext_map.get(ct_header, ext_from_url)
-                    if extension not in ALLOWED_FORMATS:
-                        extension = DEFAULT_FORMAT
-                    original_ext = extension
-
-                    # ── 6. Konwersje formatów ─────────────────────────────────────
-
-                    # WebP → PNG
-                    if convert_webp and original_ext == '.webp':
-                        try:
-                            image_data = convert_webp_to_png(image_data, remove_transparency=handle_transparency)
-                            extension  = '.png'
-                            stats['webp_png'] += 1
-                        except Exception as e:
-                            msg = f"EAN: {ean_label} | Błąd konwersji WebP→PNG: {e}"
-                            errors_log.append(msg)
-                            log_expander.error(msg)
-                            stats['blad'] += 1
-                            time.sleep(delay_between)
-                            continue
-
-                    # GIF → JPG
-                    elif convert_gif and original_ext == '.gif':
-                        try:
-                            image_data = convert_to_jpg(image_data, source_format='.gif')
-                            extension  = '.jpg'
-                            stats['gif_jpg'] += 1
-                        except Exception as e:
-                            msg = f"EAN: {ean_label} | Błąd konwersji GIF→JPG: {e}"
-                            errors_log.append(msg)
-                            log_expander.error(msg)
-                            stats['blad'] += 1
-                            time.sleep(delay_between)
-                            continue
-
-                    # BMP → JPG
-                    elif convert_bmp and original_ext == '.bmp':
-                        try:
-                            image_data = convert_to_jpg(image_data, source_format='.bmp')
-                            extension  = '.jpg'
-                            stats['bmp_jpg'] += 1
-                        except Exception as e:
-                            msg = f"EAN: {ean_label} | Błąd konwersji BMP→JPG: {e}"
-                            errors_log.append(msg)
-                            log_expander.error(msg)
-                            stats['blad'] += 1
-                            time.sleep(delay_between)
-                            continue
-
-                    # Białe tło dla pozostałych formatów (JPG/PNG) z przezroczystością
-                    else:
-                        if handle_transparency:
-                            processed = add_white_background(image_data)
-                            if processed != image_data:
-                                image_data = processed
-                                stats['transparency_fixed'] += 1
-
-                    # ── 7. Zapis ──────────────────────────────────────────────────
-                    filename = f"{ean}{extension}" if col_num == 0 else f"{ean_label}{extension}"
-                    if filename in downloaded_files and not overwrite:
-                        stats['istnieje'] += 1
-                        time.sleep(delay_between)
-                        continue
-
-                    downloaded_files[filename] = image_data
-                    stats['sukces'] += 1
-
-                    time.sleep(delay_between)
-
-            # ── Podsumowanie pominięć ─────────────────────────────────────────
-            if skipped_log:
-                with st.expander(f"📋 Pominięte pliki ({len(skipped_log)})", expanded=False):
-                    for msg in skipped_log:
-                        st.warning(msg)
+                downloaded_files[filename] = wynik['data']
+                stats['sukces'] += 1
 
             # Ustal raz na zawsze kolejność EAN-ów (stabilna, niezależna od kluczy słownika)
             ean_order = []
@@ -526,6 +824,7 @@ if uploaded_file is not None:
                 'downloaded_files': downloaded_files,
                 'missing_eans': ean_filter_set - found_eans if ean_filter_set else None,
                 'ean_order': ean_order,
+                'zip_data': None,
             }
             st.rerun()
 
@@ -544,15 +843,29 @@ if uploaded_file is not None:
             c4.metric("🎨 Białe tło",       s['transparency_fixed'])
 
             c5, c6, c7 = st.columns(3)
-            c5.metric("🔄 WebP → PNG",  s['webp_png'])
+            c5.metric("🔄 WebP → PNG/JPG", s['webp'])
             c6.metric("🎞️ GIF → JPG",   s['gif_jpg'])
             c7.metric("🖼️ BMP → JPG",   s['bmp_jpg'])
 
+            # Dziennik renderowany raz, jedną tabelą (zamiast osobnego elementu na każdy wpis)
+            n_log = len(res['errors_log']) + len(res['skipped_log'])
+            if n_log:
+                with st.expander(f"⚠️ Dziennik zdarzeń ({n_log})", expanded=False):
+                    st.dataframe(
+                        pd.DataFrame(
+                            [{'Typ': '❌ Błąd', 'Komunikat': msg} for msg in res['errors_log']]
+                            + [{'Typ': '⏭️ Pominięto', 'Komunikat': msg} for msg in res['skipped_log']]
+                        ),
+                        hide_index=True, use_container_width=True
+                    )
+
             if s['sukces'] > 0:
-                zip_data = create_zip_from_memory(res['downloaded_files'])
+                # Archiwum budowane raz na wynik, a nie przy każdym przeładowaniu strony
+                if res.get('zip_data') is None:
+                    res['zip_data'] = create_zip_from_memory(res['downloaded_files'])
                 st.download_button(
                     label=f"⬇️ POBIERZ PACZKĘ ZIP ({s['sukces']} plików)",
-                    data=zip_data,
+                    data=res['zip_data'],
                     file_name=f"okladki_{datetime.now().strftime('%H%M%S')}.zip",
                     mime="application/zip",
                     type="primary",
@@ -574,22 +887,24 @@ if uploaded_file is not None:
                 seen_eans = res['ean_order']
 
                 # Zbuduj strukturę danych dla JS: {ean: {suf: base64_png | null}}
+                # Miniatury liczone raz i trzymane w wynikach — przeładowania strony ich nie dekodują
+                miniatury = res.setdefault('miniatury', {})
+                po_nazwie = {}
+                for fn in downloaded_files:
+                    po_nazwie.setdefault(fn.rsplit('.', 1)[0], fn)
+
                 rows_data = []
                 for ean in seen_eans:
                     cols_data = []
                     for suf, lbl in zip(SUFFIXES, SUFFIX_LABELS):
-                        target_base = f"{ean}{suf}"
-                        match = next((fn for fn in downloaded_files if fn.rsplit('.', 1)[0] == target_base), None)
-                        if match:
+                        match = po_nazwie.get(f"{ean}{suf}")
+                        if match and match not in miniatury:
                             try:
-                                img = Image.open(io.BytesIO(downloaded_files[match]))
-                                img.thumbnail((THUMB_SIZE, THUMB_SIZE))
-                                buf = io.BytesIO()
-                                img.save(buf, format='PNG')
-                                b64 = base64.b64encode(buf.getvalue()).decode()
-                                cols_data.append({'suf': suf, 'label': lbl, 'img': b64, 'fname': match})
+                                miniatury[match] = miniatura_b64(downloaded_files[match], THUMB_SIZE)
                             except Exception:
-                                cols_data.append({'suf': suf, 'label': lbl, 'img': None, 'fname': None})
+                                miniatury[match] = None
+                        if match and miniatury[match]:
+                            cols_data.append({'suf': suf, 'label': lbl, 'img': miniatury[match], 'fname': match})
                         else:
                             cols_data.append({'suf': suf, 'label': lbl, 'img': None, 'fname': None})
                     rows_data.append({'ean': ean, 'cols': cols_data})
@@ -757,4 +1072,4 @@ buildTable();
         st.error(f"Wystąpił błąd krytyczny: {e}")
 
 else:
-    st.info("💡 Wgraj plik Excel, aby rozpocząć.")
+    st.info("💡 Wgraj plik Excel lub CSV, aby rozpocząć.")
@@ -4,6 +4,9 @@ import io
 import zipfile
 from datetime import datetime
 
+# Formaty już skompresowane — w ZIP zapisywane bez ponownego DEFLATE
+COMPRESSED_FORMATS = frozenset({'png', 'jpg', 'jpeg', 'gif', 'webp'})
+
 
 # Custom CSS
 st.markdown("""
@@ -50,19 +53,24 @@ def convert_image(image_bytes, input_format, output_format, quality=95):
         
         if save_format == 'JPEG':
             image.save(output, format=save_format, quality=quality, optimize=True)
+        elif save_format == 'PNG':
+            # optimize=True (zlib 9 + dobór filtrów) jest wielokrotnie wolniejsze przy zysku ~0–3%
+            image.save(output, format=save_format, compress_level=6)
         else:
-            image.save(output, format=save_format, optimize=True)
+            image.save(output, format=save_format)
         
         return output.getvalue()
     except Exception as e:
         raise Exception(f"Błąd konwersji: {str(e)}")
 
 def create_zip(files_dict):
-    """Tworzy archiwum ZIP z plików"""
+    """Tworzy archiwum ZIP z plików (PNG/JPG bez ponownej kompresji)"""
     zip_buffer = io.BytesIO()
-    with zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_DEFLATED) as zip_file:
+    with zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_DEFLATED, compresslevel=1) as zip_file:
         for filename, file_data in files_dict.items():
-            zip_file.writestr(filename, file_data)
+            ext = filename.rsplit('.', 1)[-1].lower()
+            compress_type = zipfile.ZIP_STORED if ext in COMPRESSED_FORMATS else zipfile.ZIP_DEFLATED
+            zip_file.writestr(filename, file_data, compress_type=compress_type)
     zip_buffer.seek(0)
     return zip_buffer
 
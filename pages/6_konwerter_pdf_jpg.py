@@ -42,9 +42,9 @@ def convert_pdf_to_jpg(pdf_bytes: bytes) -> tuple[dict, int]:
 
 
 def create_zip(files_dict: dict) -> io.BytesIO:
-    """Tworzy archiwum ZIP."""
+    """Tworzy archiwum ZIP (bez kompresji — JPEG jest już skompresowany)."""
     zip_buffer = io.BytesIO()
-    with zipfile.ZipFile(zip_buffer, "w", zipfile.ZIP_DEFLATED) as zf:
+    with zipfile.ZipFile(zip_buffer, "w", zipfile.ZIP_STORED) as zf:
         for name, data in files_dict.items():
             zf.writestr(name, data)
     zip_buffer.seek(0)
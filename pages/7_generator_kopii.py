@@ -63,7 +63,8 @@ def create_zip(image_sets):
     zip_buffer = BytesIO()
     existing_names = set()
 
-    with zipfile.ZipFile(zip_buffer, "w", zipfile.ZIP_DEFLATED) as zip_file:
+    # PNG jest już skompresowany — ZIP_STORED to samo kopiowanie bajtów (+ CRC)
+    with zipfile.ZipFile(zip_buffer, "w", zipfile.ZIP_STORED) as zip_file:
         for image_bytes, names in image_sets:
             file_names = make_unique_filenames(names, existing_names)
             for file_name in file_names: